@@ -0,0 +1,46 @@
+"""
+Helpers for working with DuckDB that are shared by the scripts in this folder. The scripts
+are run as `python code/<script>.py`, so they can import this module directly:
+
+```
+from duckdb_utils import connect, quote_identifier, quote_literal
+```
+"""
+
+import os
+import duckdb as ddb
+
+#######################
+
+def connect() -> ddb.duckdb.DuckDBPyConnection:
+    """
+    Open an in-memory DuckDB connection set up for the pipeline. All the cores are used, the memory
+    limit is left to DuckDB unless set through `FD_MEM_LIMIT` (e.g. '8GB'), and PARQUET metadata
+    is cached between the queries
+    :return: initialized duckdb connection
+    """
+    con = ddb.connect()
+    if os.cpu_count() is not None:
+        con.execute(f"PRAGMA threads={os.cpu_count()}")
+    if 'FD_MEM_LIMIT' in os.environ:
+        con.execute(f"PRAGMA memory_limit={quote_literal(os.environ['FD_MEM_LIMIT'])}")
+    con.execute("PRAGMA enable_object_cache")
+
+    return con
+
+def quote_identifier(name: str) -> str:
+    """
+    Quote a name (e.g. of a column), so that it can be safely used as an identifier in SQL
+    :param name: name to quote
+    :return: quoted name, e.g. `posEntryMode` becomes `"posEntryMode"`
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+def quote_literal(value: str) -> str:
+    """
+    Quote a string (e.g. a path), so that it can be safely used as a string literal in SQL
+    where DuckDB does not allow it to be passed as a parameter (views, COPY, PRAGMA)
+    :param value: string to quote
+    :return: quoted string, e.g. `data/labels.parquet` becomes `'data/labels.parquet'`
+    """
+    return "'" + value.replace("'", "''") + "'"
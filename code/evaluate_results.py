@@ -60,8 +60,8 @@ import typing as tp
 import numpy as np
 import numpy.random as npr
 import pandas as pd
-import duckdb as ddb
 import datetime as dt
+from duckdb_utils import connect
 
 
 #######################
@@ -240,20 +240,20 @@ def main(args=None)->None:
     if args is None:
         args = parse_arguments()
 
-    con = ddb.connect()
+    con = connect()
 
     ############ load data
     # load predictions
     print(f'Loading predictions from {args.source_predictions}')
-    con.execute(f"CREATE TABLE model_predictions AS SELECT eventId, score FROM '{args.source_predictions}'")
+    con.execute("CREATE TABLE model_predictions AS SELECT eventId, score FROM read_parquet(?)", [args.source_predictions])
 
     # load labels
     print(f'Loading labels from {args.source_dataset}')
-    con.execute(f"CREATE TABLE model_dataset AS SELECT eventId, is_fraud_flag FROM '{args.source_dataset}'")
+    con.execute("CREATE TABLE model_dataset AS SELECT eventId, is_fraud_flag FROM read_parquet(?)", [args.source_dataset])
 
     # load time-stamp
     print(f'Loading timestamp from {args.source_txns}')
-    con.execute(f"CREATE TABLE txns AS SELECT eventId, transactionAmount, transactionTime FROM '{args.source_txns}'")
+    con.execute("CREATE TABLE txns AS SELECT eventId, transactionAmount, transactionTime FROM read_parquet(?)", [args.source_txns])
 
     eval_df = con.execute(
         f"""
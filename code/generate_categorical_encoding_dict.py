@@ -27,6 +27,9 @@ import json
 import typing as tp
 import duckdb as ddb
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from duckdb_utils import connect, quote_identifier, quote_literal
 
 def parse_arguments() ->  argparse.Namespace:
     """
@@ -69,44 +72,80 @@ def parse_arguments() ->  argparse.Namespace:
 
 ##########################
 
-def frequency_encode_feature(
+def count_feature_values(
         con: ddb.duckdb.DuckDBPyConnection,
-        feature_name: str
+        feature_name_list: tp.List[str]
+)->pa.Table:
+    """
+    Count how many times each value of every feature in `feature_name_list` occurs in `data_table`.
+    All the features are counted in a single pass over the table (one GROUPING SET per feature),
+    rather than running a separate GROUP BY for each feature.
+
+    :param con: initialized duckdb connection
+    :param feature_name_list: names of the features to count (expecting to find them in table `data_table`)
+    :return: arrow table with columns `feature_name`, `feature_value` and `row_count`, one row per
+        feature-value combination. Values are cast to strings, missing values are reported as 'NULL'
+    """
+
+    # within a grouping set only the feature that is being grouped on has GROUPING(...)=0
+    # use this to label the rows and to pick the value out of the right column
+    # (feature names are used as quoted identifiers, and passed as parameters for the labels)
+    quoted_name_list = [quote_identifier(fn) for fn in feature_name_list]
+    feature_name_sql = '\n'.join([
+        f"WHEN GROUPING({qfn})=0 THEN ${i_fn+1}" for i_fn, qfn in enumerate(quoted_name_list)
+    ])
+    feature_value_sql = '\n'.join([
+        f"WHEN GROUPING({qfn})=0 THEN IFNULL(CAST({qfn} AS VARCHAR), 'NULL')" for qfn in quoted_name_list
+    ])
+    grouping_sets_sql = ', '.join([f'({qfn})' for qfn in quoted_name_list])
+
+    cat_counts_tbl = con.execute(
+        f"""
+            SELECT
+                CASE {feature_name_sql} END AS feature_name,
+                CASE {feature_value_sql} END AS feature_value,
+                COUNT(*) AS row_count
+            FROM data_table
+            GROUP BY GROUPING SETS ({grouping_sets_sql})
+            """,
+        feature_name_list
+    ).arrow()
+
+    return cat_counts_tbl
+
+##########################
+
+def frequency_encode_feature(
+        cat_counts_tbl: pa.Table
 )->tp.Dict[str, float]:
     """
-    Generate a dictionary with frequency encoding for a categorical table. The input
-    is an initialized DuckDB connector with `data_table` table that contains field `feature_name`.
-    The count how many times each value of this feature occurs in the population, end then generate
-    a frequency encoding. For example for feature_values ['a', 'b', 'a', 'c', 'b', 'a']
+    Generate a dictionary with frequency encoding for a categorical feature. The input
+    is a table with counts of how many times each value of this feature occurs in the population
+    (see `count_feature_values`), from which the frequency encoding is generated.
+    For example for feature_values ['a', 'b', 'a', 'c', 'b', 'a']
 
     The encoding will be: {'a': 3/6, 'b': (3+2)/6, 'c': (3+2+1)/6}
     The encoding is normalized cumulative counts of value occurrence
 
-    :param con: initialized duckdb connection
-    :param feature_name: name of the feauture to encode (expecting to find it in table `data_table`)
+    :param cat_counts_tbl: arrow table with columns `feature_value` and `row_count` for a single feature
     :return: dictionary with encoding, as described above
     """
 
     # initially planned to use SQL to do cumulative sum as well, but SUM(...) OVER(...)
     # seems to be using something like float32 by default, which leads to overflows
     # using numpy with float64 to avoid this, hence handling the cumsum in python
-    cat_counts_df = con.execute(
-        f"""
-            SELECT
-                IFNULL({feature_name}, 'NULL') AS {feature_name},
-                COUNT(*) AS row_count
-            FROM data_table
-            GROUP BY {feature_name}
-            """
-    ).df().sort_values('row_count', ascending=False)
+    # sort in arrow, most frequent first, and only then hand the counts over to numpy
+    sort_idx_arr = pc.sort_indices(cat_counts_tbl, sort_keys=[('row_count', 'descending')])
+    cat_counts_tbl = cat_counts_tbl.take(sort_idx_arr).combine_chunks()
 
-    feature_cat_name_arr = cat_counts_df[feature_name].values
-    feature_cumul_counts_arr = np.cumsum(cat_counts_df.row_count.values)
-    feature_enc_arr = feature_cumul_counts_arr / np.max(feature_cumul_counts_arr)
+    feature_cat_name_arr = cat_counts_tbl.column('feature_value').to_pylist()
+    feature_count_arr = cat_counts_tbl.column('row_count').chunk(0).to_numpy(zero_copy_only=True)
+    feature_cumul_counts_arr = np.add.accumulate(feature_count_arr, dtype=np.float64)
+    # counts are positive, so the last cumulative count is also the largest one
+    feature_enc_arr = feature_cumul_counts_arr / feature_cumul_counts_arr[-1]
 
-    freq_enc_dict = {
-        name: val for name, val in zip(feature_cat_name_arr, feature_enc_arr)
-    }
+    # convert to python floats in one go, so that the dictionary can be saved as JSON directly
+    freq_enc_dict = dict(zip(feature_cat_name_arr, feature_enc_arr.tolist()))
 
     return freq_enc_dict
 
@@ -125,15 +164,21 @@ def main(args=None)->None:
     print('Building dictionaries for encoding the categorical features into numerical values')
 
     #### initialize db connection
-    con = ddb.connect()
-    con.execute(f"CREATE TABLE data_table AS SELECT * FROM '{args.source_data_table}'")
+    con = connect()
+    # a view, rather than a table, so that only the columns that are counted are read from PARQUET
+    con.execute(f"CREATE VIEW data_table AS SELECT * FROM read_parquet({quote_literal(args.source_data_table)})")
 
     assert len(args.categorical_feature_list) > 0, 'Expecting at least one categorical feature name'
 
+    print(f'Counting values of {len(args.categorical_feature_list)} features')
+    cat_counts_tbl = count_feature_values(con, args.categorical_feature_list)
+
     enc_dict = {}
     for i_fn, fn in enumerate(args.categorical_feature_list):
         print(f'Encoding {fn} ({i_fn+1}/{len(args.categorical_feature_list)})')
-        enc_dict[fn] = frequency_encode_feature(con, fn)
+        enc_dict[fn] = frequency_encode_feature(
+            cat_counts_tbl.filter(pc.equal(cat_counts_tbl['feature_name'], fn))
+        )
 
     print(f'Saving encoding to {args.destination_categorical_encoding_dict}')
 
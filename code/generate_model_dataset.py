@@ -27,8 +27,8 @@ The columns that will be used by the model are encoded in this script. For now,
 not to parametrize this any further as it will increase complexity. Day-2 move might
 be to make features selected for the model be specified in some external config file
 
-NOTE! As part of the execution the transactions are loaded fully into the memory, if
-the file is too big, break it into smaller sections and run script on them indepently
+The categorical encoding is applied within DuckDB, and the result is written straight into
+the PARQUET file, so the transactions do not need to be loaded into memory as a dataframe
 
 Typical columns in the dataset are:
     eventId - reserved name (string) for the id of rows
@@ -44,10 +44,11 @@ Typical columns in the dataset are:
 """
 
 import argparse
-import duckdb as ddb
 import json
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+from duckdb_utils import connect, quote_identifier, quote_literal
 
 def parse_arguments() ->  argparse.Namespace:
     """
@@ -113,17 +114,28 @@ def main(args=None)->None:
     row_id_name = 'eventId'
 
     #### initialize db connection
-    con = ddb.connect()
+    con = connect()
 
+    # views rather than tables, DuckDB will only read the columns that are needed
+    # directly from the PARQUET files, when the final query is executed
     print('Loading txns')
-    con.execute(f"CREATE TABLE txns AS SELECT * FROM '{args.source_txns_table}'")
+    con.execute(f"CREATE VIEW txns AS SELECT * FROM read_parquet({quote_literal(args.source_txns_table)})")
 
     labels_provided = (args.source_labels_table is not None)
     if labels_provided:
         print('Loading labels')
-        con.execute(f"CREATE TABLE labels AS SELECT * FROM '{args.source_labels_table}'")
+        con.execute(f"CREATE VIEW labels AS SELECT * FROM read_parquet({quote_literal(args.source_labels_table)})")
+
+        # only whether a label exists for the transaction matters, so a semi-join is enough
+        is_fraud_flag_sql = """
+            CASE
+                WHEN EXISTS (SELECT 1 FROM labels AS L WHERE L.eventId=T.eventId) THEN 1
+                ELSE 0
+            END
+        """
     else:
-        con.execute(f"CREATE TABLE labels (reportedTime TIMESTAMP, eventId STRING);")
+        # without labels the flag is a constant, and there is nothing to join
+        is_fraud_flag_sql = '-1'
 
     enc_dict_provided = (args.source_categorical_encoding_dict is not None)
     if enc_dict_provided:
@@ -134,16 +146,14 @@ def main(args=None)->None:
     else:
         cat_enc_dict = None
 
-    ### create a single table with all features, without handling
-    # categorical values
+    ### create a view with all features, without handling categorical values
     # this is essentially where the tables that will be used for ML are selected
     print('Preparing key fields')
     con.execute(
         f"""
-        CREATE TABLE full_table AS (
+        CREATE VIEW core_vw AS (
             SELECT
                 T.{row_id_name},
-                T.transactionTime,
                 MONTH(T.transactionTime) AS txn_month,
                 DAYOFMONTH(T.transactionTime) AS txn_day_of_month,
                 DAYOFWEEK(T.transactionTime) AS txn_day_of_week,
@@ -151,42 +161,21 @@ def main(args=None)->None:
                 T.posEntryMode,
                 T.transactionAmount,
                 T.availableCash,
-                L.reportedTime,
+                {is_fraud_flag_sql} AS is_fraud_flag,
             FROM txns AS T
-            LEFT JOIN labels AS L
-                ON L.eventId=T.eventId
         )
         """
     )
-
-    ### load the table as a dataframe
-    print('Loading the dataframe...')
-    prelim_dataset_df = con.execute(
-        f"""
-        WITH
-        core_vw AS (
-            SELECT 
-                * EXCLUDE(transactionTime, reportedTime),
-                CASE
-                    WHEN reportedTime IS NULL THEN {'0' if labels_provided else '-1'}
-                    ELSE 1
-                END AS is_fraud_flag,
-            FROM full_table
-        )
-    
-        SELECT
-            *
-        FROM core_vw
-        """
-    ).df()
-    #
-    print(f'Loaded {len(prelim_dataset_df)} rows. Columns {prelim_dataset_df.columns}')
+    # the schema is all that is needed here, so no rows are fetched
+    core_schema = con.execute('SELECT * FROM core_vw LIMIT 0').arrow().schema
+    print(f'Columns {core_schema.names}')
 
     # handle categorical values
     print(f'Handling the following categorical features: ')
     categorical_feature_list = []
-    for col_name in prelim_dataset_df.columns:
-        if ((prelim_dataset_df.dtypes[col_name]==type(str)) and (col_name!=row_id_name)):
+    for col_field in core_schema:
+        col_name = col_field.name
+        if ((pa.types.is_string(col_field.type) or pa.types.is_large_string(col_field.type)) and (col_name!=row_id_name)):
 
             if cat_enc_dict is not None and col_name in cat_enc_dict:
                 print(f'\t{col_name}')
@@ -194,33 +183,86 @@ def main(args=None)->None:
             else:
                 raise Exception(f'Categorical encoding for `{col_name}` is missing')
 
-    # apply encoding to the categorical features
     if len(categorical_feature_list) == 0:
         print('No categorical features')
-        dataset_df = prelim_dataset_df
-    else:
-        # all the non-categorical columns
-        dataset_df = prelim_dataset_df[[
-            col for col in prelim_dataset_df.columns if col not in categorical_feature_list
-        ]]
-
-        # assign numberical values instead of categorical ones
-        for cat_feat in categorical_feature_list:
-            print(f'Mapping `{cat_feat}`')
-            replace_func = np.vectorize(cat_enc_dict[cat_feat].get)
-            mapped_field_vals = replace_func(prelim_dataset_df[cat_feat].values)
-
-            # handle values that do not occur in the dictionary
-            # there should be no such values, if there are
-            # the sanest option is to fail loud
-            if not np.all(np.isfinite(mapped_field_vals)):
-                raise Exception('Some values have not been found in the dictionary!')
-
-            dataset_df = dataset_df.assign(**{cat_feat: mapped_field_vals})
-
-    ### fully loaded, can now save
+
+    # make the encodings available to DuckDB as tables with columns
+    # `feature_value` and `feature_enc`, so that they can be joined on
+    # missing values are encoded under 'NULL' (see `generate_categorical_encoding_dict.py`)
+    # (feature names are used as quoted identifiers, encoding tables are named by the feature)
+    quoted_feat_dict = {cat_feat: quote_identifier(cat_feat) for cat_feat in categorical_feature_list}
+    quoted_enc_dict = {cat_feat: quote_identifier(f'enc_{cat_feat}') for cat_feat in categorical_feature_list}
+    #
+    for cat_feat in categorical_feature_list:
+        print(f'Mapping `{cat_feat}`')
+        con.register(
+            f'enc_{cat_feat}',
+            pd.DataFrame({
+                'feature_value': list(cat_enc_dict[cat_feat].keys()),
+                'feature_enc': np.fromiter(cat_enc_dict[cat_feat].values(), dtype=np.float64)
+            })
+        )
+
+        # handle values that do not occur in the dictionary
+        # there should be no such values, if there are
+        # the sanest option is to fail loud
+        # (the values are made unique first, so the dictionary is only
+        # probed once per unique value, rather than once per row)
+        missing_value_list = [row[0] for row in con.execute(
+            f"""
+            WITH
+            unique_vw AS (
+                SELECT DISTINCT
+                    IFNULL({quoted_feat_dict[cat_feat]}, 'NULL') AS feature_value
+                FROM core_vw
+            )
+
+            SELECT
+                U.feature_value
+            FROM unique_vw AS U
+            ANTI JOIN {quoted_enc_dict[cat_feat]} AS E
+                ON E.feature_value=U.feature_value
+            LIMIT 10
+            """
+        ).fetchall()]
+        #
+        if len(missing_value_list) > 0:
+            raise Exception(
+                f'Some values of `{cat_feat}` have not been found in the dictionary! ' + \
+                f'For example: {missing_value_list}'
+            )
+
+    # categorical features are replaced by their encodings, and moved to the end
+    # of the table (the order of the features is the order in which the model sees them)
+    select_sql = ', '.join(
+        [
+            'C.* EXCLUDE(' + ', '.join(quoted_feat_dict.values()) + ')'
+            if len(categorical_feature_list) > 0 else 'C.*'
+        ] +
+        [
+            f'E{i_feat}.feature_enc AS {quoted_feat_dict[cat_feat]}'
+            for i_feat, cat_feat in enumerate(categorical_feature_list)
+        ]
+    )
+    join_sql = '\n'.join([
+        f"LEFT JOIN {quoted_enc_dict[cat_feat]} AS E{i_feat} " + \
+        f"ON E{i_feat}.feature_value=IFNULL(C.{quoted_feat_dict[cat_feat]}, 'NULL')"
+        for i_feat, cat_feat in enumerate(categorical_feature_list)
+    ])
+
+    ### DuckDB streams the dataset straight into the PARQUET file
     print(f'Saving to {args.destination_model_dataset}')
-    dataset_df.to_parquet(args.destination_model_dataset)
+    row_count = con.execute(
+        f"""
+        COPY (
+            SELECT
+                {select_sql}
+            FROM core_vw AS C
+            {join_sql}
+        ) TO {quote_literal(args.destination_model_dataset)} (FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 1048576)
+        """
+    ).fetchone()[0]
+    print(f'Saved {row_count} rows')
     print('Done')
 
     con.close()
@@ -19,6 +19,7 @@ Relies on duckdb to handle structured data. See `python code/ingest_and_split.py
 import duckdb as ddb
 import argparse
 import numpy as np
+from duckdb_utils import connect, quote_literal
 
 
 #######################
@@ -103,7 +104,7 @@ def load_source_txns(
     """
     Given initialized duck-db connection, and a location of a CSV file with transactions
     data, load this data into the connection, call the loaded table `txns_table_name`
-    append a row number based on hash - it will be used to randomly split data later.
+    append a hash of the row - it will be used to randomly split data later.
 
     The loaded table will contain data with the following schema
     'transactionTime': 'TIMESTAMP',
@@ -116,7 +117,7 @@ def load_source_txns(
     'posEntryMode': 'VARCHAR',
     'transactionAmount': 'DOUBLE',
     'availableCash': 'DOUBLE'
-    'random_row_order': 'INT'
+    'random_row_hash': 'UBIGINT'
 
     :param con: initialized duckdb connection
     :param source_txn_csv: path to the CSV with source transactions
@@ -125,16 +126,14 @@ def load_source_txns(
     """
 
     # load
-    con.execute(f"""
+    con.execute("""
         CREATE TABLE txns AS
         SELECT 
             *, 
-            ROW_NUMBER() OVER(
-                ORDER BY HASH(CONCAT(CAST(transactionTime AS STRING), eventId, '{split_hash}'))
-            ) AS random_row_order
+            HASH(CONCAT(CAST(transactionTime AS STRING), eventId, $split_hash)) AS random_row_hash
         FROM read_csv_auto(
-            '{source_txn_csv}', 
-            types={{ 
+            $source_txn_csv, 
+            types={ 
                 'transactionTime': 'TIMESTAMP', 
                 'eventId': 'VARCHAR',
                 'accountNumber': 'VARCHAR',
@@ -145,9 +144,9 @@ def load_source_txns(
                 'posEntryMode': 'VARCHAR',
                 'transactionAmount': 'DOUBLE',
                 'availableCash': 'DOUBLE'
-            }}
+            }
         )
-    """)
+    """, {'split_hash': split_hash, 'source_txn_csv': source_txn_csv})
 
 
 ################
@@ -171,50 +170,54 @@ def split_txns_and_save(
     """
 
 
-    row_count = con.execute(
-        f'SELECT MAX(random_row_order) AS row_count FROM txns'
-    ).df().row_count.iloc[0]
-    print(f'Loaded {row_count} rows')
-
+    # the row counts are reported by the COPY statements, so there is
+    # no need for a separate scan of the table just to count the rows
     if validate_fraction > -0.5:
         print(f'Splitting data into train-validate...')
         assert validate_fraction > 0.0 and validate_fraction < 1.0
-        to_validate_row_count = np.floor(row_count * validate_fraction).astype(int)
-        print(
-            f'Rows count selected for validation {to_validate_row_count} ' + \
-            f'({to_validate_row_count / row_count * 100:.1f}%)'
-        )
+        # row hashes are uniformly distributed over 64-bit unsigned integers, so rows with the hash
+        # below the threshold are a random selection of `validate_fraction` of all the rows
+        # (no need to sort the rows to split them)
+        validate_hash_threshold = int(np.floor(validate_fraction * 2**64))
         #
         print(f'Saving validation transactions ({destination_txn_validate}) ... ')
         # Save the table as a Parquet file
-        con.execute(
+        to_validate_row_count = con.execute(
             f"""
             COPY (
-                SELECT * EXCLUDE(random_row_order) FROM txns WHERE random_row_order<={to_validate_row_count}
-            ) TO '{destination_txn_validate}' (FORMAT PARQUET)
+                SELECT * EXCLUDE(random_row_hash) FROM txns WHERE random_row_hash<{validate_hash_threshold}
+            ) TO {quote_literal(destination_txn_validate)} (FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 1048576)
             """
-        )
+        ).fetchone()[0]
         #
         print(f'Saving train/test transactions ({destination_txn_train}) ... ')
         # Save the table as a Parquet file
-        con.execute(
+        to_train_row_count = con.execute(
             f"""
             COPY (
-                SELECT * EXCLUDE(random_row_order) FROM txns WHERE random_row_order>{to_validate_row_count}
-            ) TO '{destination_txn_train}' (FORMAT PARQUET)
+                SELECT * EXCLUDE(random_row_hash) FROM txns WHERE random_row_hash>={validate_hash_threshold}
+            ) TO {quote_literal(destination_txn_train)} (FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 1048576)
             """
+        ).fetchone()[0]
+        #
+        row_count = to_validate_row_count + to_train_row_count
+        print(f'Saved {row_count} rows')
+        print(
+            f'Rows count selected for validation {to_validate_row_count} ' + \
+            f'({to_validate_row_count / max(row_count, 1) * 100:.1f}%)'
         )
 
     else:
         print('Saving only the train datadset')
 
-        con.execute(
+        row_count = con.execute(
             f"""
             COPY (
-                SELECT * EXCLUDE(random_row_order) FROM txns
-            ) TO '{destination_txn_train}' (FORMAT PARQUET)
+                SELECT * EXCLUDE(random_row_hash) FROM txns
+            ) TO {quote_literal(destination_txn_train)} (FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 1048576)
             """
-        )
+        ).fetchone()[0]
+        print(f'Saved {row_count} rows')
 
 
 ################
@@ -234,24 +237,24 @@ def ingest_labels(
     :return:
     """
 
-    con.execute(f"""
+    con.execute("""
         CREATE TABLE labels AS
         SELECT 
             *
         FROM read_csv_auto(
-            '{source_labels_csv}', 
-            types={{ 
+            $source_labels_csv, 
+            types={ 
                 'reportedTime': 'TIMESTAMP', 
                 'eventId': 'VARCHAR'
-            }}
+            }
         )
-    """)
+    """, {'source_labels_csv': source_labels_csv})
     #
     con.execute(
         f"""
         COPY (
             SELECT * FROM labels
-        ) TO '{destination_labels}' (FORMAT PARQUET)
+        ) TO {quote_literal(destination_labels)} (FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 1048576)
         """
     )
 
@@ -269,10 +272,10 @@ def main(args=None)->None:
         args = parse_arguments()
 
     #### initialize db connection
-    con = ddb.connect()
+    con = connect()
 
     #### load the data from csv into the connection
-    # also add a row by which we will be able to train-validate randomize
+    # also add a row hash by which we will be able to train-validate randomize
     print('Loading transactions...')
     load_source_txns(
         con=con,
@@ -12,15 +12,18 @@ python code/predict.py \
 
 Where:
     `source_dataset` - is the PARQUET file with model data for predictions (see `generate_model_dataset.py`)
-    `source_model` - is the JSON-saved model for predictions (see `train_model.py`)
+    `source_model` - is the JSON-saved model for predictions (see `train_model.py`), models
+        saved in CatBoost binary format are recognized by the `.cbm` extension
     `destination_predictions` - is the destination for the PARQUET file with predictions
         it will have columns `eventId` and `score`, the latter being the score indiciating the fraud risk
+    `batch_size` - optional, number of rows that are scored at a time (limits the memory use)
 """
 
 import argparse
 import catboost as cb
 import numpy as np
-import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 #######################
 
@@ -30,7 +33,7 @@ def parse_arguments() ->  argparse.Namespace:
     the command line arguments
     :return: parsed arguments, args = parser.parse_args()
         which will contain args.source_dataset, args.source_model
-        args.destination_predictions
+        args.destination_predictions, args.batch_size
     """
 
     # Initialize the argument parser
@@ -48,7 +51,7 @@ def parse_arguments() ->  argparse.Namespace:
         '--source_model',
         type=str,
         required=True,
-        help='Trained model saved as a JSON (see `train_model.py`)'
+        help='Trained model saved as a JSON or as a `.cbm` binary (see `train_model.py`)'
     )
     #
     parser.add_argument(
@@ -57,6 +60,14 @@ def parse_arguments() ->  argparse.Namespace:
         required=True,
         help='Path to save the predictions (PARQUET)'
     )
+    #
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        required=False,
+        default=65536,
+        help='Number of rows that are read, scored and saved at a time'
+    )
 
     # Parse the arguments
     args = parser.parse_args()
@@ -76,24 +87,45 @@ def main(args=None)->None:
     if args is None:
         args = parse_arguments()
 
-    print(f'Reading {args.source_dataset}')
-    full_df = pd.read_parquet(args.source_dataset)
-    event_id_col = full_df.pop('eventId')
-    #label_col = full_df.pop('is_fraud_flag')
+    # name of the id for different transactions
+    row_id_name = 'eventId'
 
     print(f'Loading {args.source_model}')
-    model = cb.CatBoostClassifier().load_model(args.source_model, format='json')
-
-    print('Generating scores')
-    model_scores = model.predict_proba(full_df)[:,1]
-
-    print(f'Saving scores to {args.destination_predictions}')
-    save_df = pd.DataFrame(
-        columns=['eventId'],
-        data=event_id_col
-    ).assign(score=model_scores)
-    print(f'Number of predictions saved {len(save_df)}')
-    save_df.to_parquet(args.destination_predictions)
+    model_format = 'cbm' if args.source_model.lower().endswith('.cbm') else 'json'
+    model = cb.CatBoostClassifier().load_model(args.source_model, format=model_format)
+    # only the columns that the model needs are read from the dataset
+    feature_name_list = model.feature_names_
+
+    # the dataset is read, scored and saved in batches, so that
+    # only a single batch has to be held in memory at any time
+    print(f'Reading {args.source_dataset}')
+    source_pf = pq.ParquetFile(args.source_dataset)
+    save_schema = pa.schema([
+        source_pf.schema_arrow.field(row_id_name),
+        pa.field('score', pa.float32())
+    ])
+
+    print(f'Generating scores and saving them to {args.destination_predictions}')
+    prediction_count = 0
+    # precision beyond float32 is meaningless for the score, so save it as float32
+    with pq.ParquetWriter(args.destination_predictions, save_schema, compression='zstd', compression_level=3) as writer:
+        for batch in source_pf.iter_batches(batch_size=args.batch_size, columns=[row_id_name] + feature_name_list):
+            # all features are numerical by now, hand them to CatBoost as a single
+            # contiguous float32 array, so it does not need to convert them column by column
+            feature_arr = np.empty((batch.num_rows, len(feature_name_list)), dtype=np.float32)
+            for i_feat, feat_name in enumerate(feature_name_list):
+                feature_arr[:, i_feat] = batch.column(feat_name).to_numpy(zero_copy_only=False)
+
+            model_scores = model.predict_proba(
+                cb.Pool(data=feature_arr, feature_names=feature_name_list)
+            )[:,1].astype(np.float32, copy=False)
+
+            writer.write_batch(
+                pa.record_batch([batch.column(row_id_name), pa.array(model_scores)], schema=save_schema)
+            )
+            prediction_count += batch.num_rows
+
+    print(f'Number of predictions saved {prediction_count}')
 
     print('Done')
 
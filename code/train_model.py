@@ -13,13 +13,25 @@ Where:
     `model_config` - a string to indicate which model configuration to use. Only a small number
         of conifurations are supported: `v0.0`, `v0.1`, `v0.2`. Invalid confiuration
         will lead to an error
-    `destination_model` - path for saving the trained model as a JSON
+    `destination_model` - path for saving the trained model as a JSON, or in CatBoost's binary format if
+        the path has the `.cbm` extension (much faster to save and load for large models, `predict.py`
+        picks the format from the extension in the same way)
+    `task_type` - optional, `CPU` (default) or `GPU`, the latter trains on CUDA device(s) listed in `devices`
+    `devices` - optional, GPU devices to use, e.g. `0` or `0:1` (ignored for CPU)
+    `border_count` - optional, number of splits for numerical features (CatBoost default if not given)
+    `pool_cache_dir` - optional, folder for caching the quantized training data. Repeated trainings
+        on the same dataset (e.g. with different model configs) will then skip the quantization
 """
 
 import argparse
+import hashlib
+import os
+import typing as tp
 import catboost as cb
+import catboost.utils
 import numpy as np
-import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 
 #######################
 
@@ -29,7 +41,8 @@ def parse_arguments() ->  argparse.Namespace:
     the command line arguments
     :return: parsed arguments, args = parser.parse_args()
         which will contain args.source_dataset, args.model_config
-        args.destination_model
+        args.destination_model, args.task_type, args.devices, args.border_count,
+        args.pool_cache_dir
     """
 
     # Initialize the argument parser
@@ -54,7 +67,40 @@ def parse_arguments() ->  argparse.Namespace:
         '--destination_model',
         type=str,
         required=True,
-        help='Path to save the trained model (JSON)'
+        help='Path to save the trained model (JSON, or CatBoost binary if the extension is `.cbm`)'
+    )
+    #
+    parser.add_argument(
+        '--task_type',
+        type=str,
+        required=False,
+        default='CPU',
+        choices=['CPU', 'GPU'],
+        help='Train on CPU or on GPU (CUDA)'
+    )
+    #
+    parser.add_argument(
+        '--devices',
+        type=str,
+        required=False,
+        default='0',
+        help='GPU devices to train on, e.g. `0` or `0:1` (only used with `--task_type=GPU`)'
+    )
+    #
+    parser.add_argument(
+        '--border_count',
+        type=int,
+        required=False,
+        default=None,
+        help='Number of splits for numerical features, smaller values (e.g. 32) speed up GPU training'
+    )
+    #
+    parser.add_argument(
+        '--pool_cache_dir',
+        type=str,
+        required=False,
+        default=None,
+        help='Folder to cache the quantized training data in (no caching if not provided)'
     )
 
     # Parse the arguments
@@ -65,6 +111,179 @@ def parse_arguments() ->  argparse.Namespace:
 
 #######################
 
+def get_model_param_dict(
+        task_type: str,
+        devices: str,
+        border_count: tp.Optional[int]
+)->tp.Dict[str, tp.Any]:
+    """
+    Build the parameters shared by all the model configurations. Checks that a GPU is
+    available if GPU training was requested
+
+    :param task_type: `CPU` or `GPU`
+    :param devices: GPU devices to use (ignored for CPU)
+    :param border_count: number of splits for numerical features, if None CatBoost default is used
+    :return: dictionary with parameters for `cb.CatBoostClassifier`
+    """
+
+    model_param_dict = {'verbose': False, 'task_type': task_type}
+
+    if task_type == 'GPU':
+        if cb.utils.get_gpu_device_count() == 0:
+            raise Exception('GPU training requested, but no CUDA devices are available')
+
+        if ':' in devices or '-' in devices:
+            print(
+                f'WARNING: several GPU devices selected ({devices}), ' + \
+                'for small datasets synchronization between devices can make training slower'
+            )
+
+        model_param_dict['devices'] = devices
+
+    if border_count is not None:
+        model_param_dict['border_count'] = border_count
+
+    return model_param_dict
+
+#######################
+
+def compute_amount_weight_vec(
+        train_Y: np.ndarray,
+        txn_amount_vec: np.ndarray,
+        target_weight: float
+)->np.ndarray:
+    """
+    Compute weights for the samples, where the targets are up-weighted by the inverse of the target rate,
+    and additionally weighted by the transaction amount. Targets get weight (1/rate)*|amount/max_amount|,
+    the rest get weight 1 (amounts can be negative, e.g. refunds, hence the absolute value)
+
+    :param train_Y: 0/1 labels
+    :param txn_amount_vec: float64 transaction amounts (not modified, can be a read-only view)
+    :param target_weight: inverse of the fraction of the targets in `train_Y` (i.e. 1/rate)
+    :return: float32 array with weights
+    """
+
+    txn_amount_max = float(np.max(txn_amount_vec))
+
+    # the weights are computed in float64 and only the result is stored as float32,
+    # rounding the intermediate values would change the trained model
+    # a single float64 buffer, the rest of the steps are done in place
+    amt_weight_vec = np.divide(txn_amount_vec, txn_amount_max, dtype=np.float64)
+    np.abs(amt_weight_vec, out=amt_weight_vec)
+    np.multiply(amt_weight_vec, target_weight, out=amt_weight_vec)
+    weight_vec = np.ones(train_Y.size, dtype=np.float32)
+    np.copyto(weight_vec, amt_weight_vec, casting='same_kind', where=(train_Y > 0))
+
+    return weight_vec
+
+#######################
+
+def load_or_build_train_pool(
+        train_X_np: np.ndarray,
+        train_Y: np.ndarray,
+        model_feature_list: tp.List[str],
+        source_dataset: str,
+        pool_cache_dir: tp.Optional[str],
+        task_type: str,
+        border_count: tp.Optional[int]
+)->cb.Pool:
+    """
+    Build the CatBoost pool for training. If the cache folder is given, the pool is quantized
+    and saved there, so that repeated trainings on the same dataset can load the quantized pool
+    instead of quantizing the features again. The cached pool is identified by the path, modification
+    time and size of the source dataset, as well as by the `task_type` and the `border_count`
+
+    :param train_X_np: float32 array with features
+    :param train_Y: array with labels
+    :param model_feature_list: names of the features (columns of `train_X_np`)
+    :param source_dataset: path to the dataset from which the features were loaded
+    :param pool_cache_dir: folder for caching the quantized pool, if None, the pool is not cached
+    :param task_type: `CPU` or `GPU`, the default number of splits depends on it
+    :param border_count: number of splits for numerical features, if None CatBoost default is used
+    :return: pool with features and labels (no weights)
+    """
+
+    if pool_cache_dir is None:
+        return cb.Pool(train_X_np, train_Y, feature_names=model_feature_list)
+
+    # the pool is quantized before training, so the default number of splits that CatBoost
+    # would use for training on this device has to be set explicitly (254 on CPU, 128 on GPU)
+    if border_count is None:
+        border_count = 128 if task_type == 'GPU' else 254
+
+    source_stat = os.stat(source_dataset)
+    cache_key = hashlib.sha256(
+        f'{os.path.abspath(source_dataset)}|{source_stat.st_mtime_ns}|{source_stat.st_size}|{task_type}|{border_count}'.encode()
+    ).hexdigest()
+    cache_path = os.path.join(pool_cache_dir, f'{cache_key}.quantized')
+
+    if os.path.exists(cache_path):
+        print(f'Loading quantized pool from {cache_path}')
+        return cb.Pool(f'quantized://{cache_path}')
+
+    print(f'Quantizing pool and saving it to {cache_path}')
+    train_pool = cb.Pool(train_X_np, train_Y, feature_names=model_feature_list)
+    train_pool.quantize(border_count=border_count)
+
+    os.makedirs(pool_cache_dir, exist_ok=True)
+    train_pool.save(cache_path)
+
+    return train_pool
+
+#######################
+
+def load_training_data(
+        source_dataset: str,
+        load_txn_amount: bool
+)->tp.Tuple[np.ndarray, np.ndarray, np.ndarray, tp.List[str]]:
+    """
+    Load the training dataset and extract the arrays needed for training. The id column
+    is not needed for training, so it is not read at all
+
+    :param source_dataset: path to the PARQUET dataset (see `generate_model_dataset.py`)
+    :param load_txn_amount: whether the transaction amounts are needed (for the weights)
+    :return: tuple with
+        float32 array with features stored column-wise,
+        uint8 array with 0/1 labels,
+        float64 array with transaction amounts (None if `load_txn_amount` is False),
+        list of the feature names (in the order of the columns of the feature array)
+    """
+
+    row_id_name = 'eventId'
+    label_name = 'is_fraud_flag'
+    column_list = [col for col in pq.read_schema(source_dataset).names if col!=row_id_name]
+    # row groups and columns are decoded in parallel threads, the file is memory-mapped,
+    # so only the pages of the projected columns are read in
+    full_tbl = pq.read_table(
+        source_dataset, columns=column_list, memory_map=True, use_threads=True, pre_buffer=True
+    )
+
+    # store the order of the features accepted by the model
+    model_feature_list = [col for col in column_list if col!=label_name]
+    # CatBoost works best with float32 data stored column-wise, so the columns are
+    # copied straight into such an array (no intermediate dataframe), rather than
+    # letting CatBoost make its own copy
+    train_X_np = np.empty((full_tbl.num_rows, len(model_feature_list)), dtype=np.float32, order='F')
+    for i_feat, feat_name in enumerate(model_feature_list):
+        train_X_np[:, i_feat] = full_tbl.column(feat_name).to_numpy()
+    # labels are 0/1 flags (-1 would mean the dataset was built without labels),
+    # a single byte per label is enough
+    label_min_max = pc.min_max(full_tbl.column(label_name)).as_py()
+    if label_min_max['min'] < 0 or label_min_max['max'] > 1:
+        raise Exception(
+            f'Expecting 0/1 labels for training, got labels in [{label_min_max["min"]}, {label_min_max["max"]}]'
+        )
+    train_Y = full_tbl.column(label_name).to_numpy().astype(np.uint8)
+
+    # amounts are kept as float64 (read-only view of the loaded column, no copy)
+    txn_amount_vec = None
+    if load_txn_amount:
+        txn_amount_vec = full_tbl.column('transactionAmount').to_numpy()
+
+    return train_X_np, train_Y, txn_amount_vec, model_feature_list
+
+#######################
+
 def main(args=None)->None:
     """
     Main entrypoint, can be called by importing the file and calling function
@@ -76,55 +295,81 @@ def main(args=None)->None:
         args = parse_arguments()
 
     # split feautes and labels
+    # the loaded table goes out of scope once the arrays are extracted,
+    # so it does not stay in memory during the training
     print(f'Reading {args.source_dataset}')
-    full_df = pd.read_parquet(args.source_dataset)
-    full_df.pop('eventId')
-    label_name = 'is_fraud_flag'
-    print(f'{len(full_df)} rows loaded')
+    train_X_np, train_Y, txn_amount_vec, model_feature_list = load_training_data(
+        args.source_dataset, load_txn_amount=(args.model_config == 'v0.3')
+    )
+    print(f'{train_Y.size} rows loaded')
 
-    # store the order of the features accepted by the model
-    model_feature_list = [col for col in full_df.columns if col!=label_name]
-    train_X = full_df[model_feature_list]
-    train_Y = full_df[label_name].values
+    model_param_dict = get_model_param_dict(
+        task_type=args.task_type,
+        devices=args.devices,
+        border_count=args.border_count
+    )
+
+    # the same pool is used by all the configs, weights are attached to it if needed
+    train_pool = load_or_build_train_pool(
+        train_X_np=train_X_np,
+        train_Y=train_Y,
+        model_feature_list=model_feature_list,
+        source_dataset=args.source_dataset,
+        pool_cache_dir=args.pool_cache_dir,
+        task_type=args.task_type,
+        border_count=args.border_count
+    )
+    # the pool holds the features now
+    del train_X_np
 
     # select model and train
-    print('Training the model....')
+    print(f'Training the model ({args.task_type})....')
     if args.model_config == 'v0.0':
         # basic model, deliberatly bad
+        # trained directly on the pool, without the classifier wrapper, and with a fixed seed
         print(f'Selected model config is {args.model_config}')
-        model = cb.CatBoostClassifier(verbose=False, iterations=2)
-        model.fit(train_X, train_Y)
+        model = cb.train(
+            pool=train_pool,
+            params={**model_param_dict, 'iterations': 2, 'loss_function': 'Logloss', 'random_seed': 0}
+        )
 
     elif args.model_config == 'v0.1':
         # basic model
         print(f'Selected model config is {args.model_config}')
-        model = cb.CatBoostClassifier(verbose=False)
-        model.fit(train_X, train_Y)
+        model = cb.CatBoostClassifier(**model_param_dict)
+        model.fit(train_pool)
 
     elif args.model_config == 'v0.2':
         # model with up-weighted targets
         print(f'Selected model config is {args.model_config}')
 
-        train_target_rate = np.mean(train_Y)
-        weight_vec = np.abs(
-            (train_Y * (1 / train_target_rate) ) + (1 - train_Y)
+        # targets get weight 1/rate, the rest get weight 1
+        # (labels are 0/1, so their sum is the number of targets)
+        train_target_count = int(np.add.reduce(train_Y, dtype=np.int64))
+        target_weight = train_Y.size / train_target_count
+        weight_vec = np.where(
+            train_Y > 0, np.float32(target_weight), np.float32(1.0)
         )
 
-        model = cb.CatBoostClassifier(verbose=False)
-        model.fit(cb.Pool(train_X, train_Y, weight=weight_vec))
+        model = cb.CatBoostClassifier(**model_param_dict)
+        train_pool.set_weight(weight_vec)
+        model.fit(train_pool)
 
     elif args.model_config == 'v0.3':
         # model with up-weighted targets, and targets additionally weighted by transactionAmount
         print(f'Selected model config is {args.model_config}')
 
-        txn_amount_vec = train_X['transactionAmount'].values
-        train_target_rate = np.mean(train_Y)
-        weight_vec = np.abs(
-            (train_Y * (1/train_target_rate) * (txn_amount_vec/np.max(txn_amount_vec))) + (1 - train_Y)
-        )
+        # (labels are 0/1, so their sum is the number of targets)
+        train_target_count = int(np.add.reduce(train_Y, dtype=np.int64))
+        target_weight = train_Y.size / train_target_count
+        weight_vec = compute_amount_weight_vec(train_Y, txn_amount_vec, target_weight)
+        del txn_amount_vec
+        # CatBoost rejects negative weights, only checked in debug runs (skipped with `python -O`)
+        assert (weight_vec >= 0).all(), 'Expecting non-negative weights'
 
-        model = cb.CatBoostClassifier(verbose=False)
-        model.fit(cb.Pool(train_X, train_Y, weight=weight_vec))
+        model = cb.CatBoostClassifier(**model_param_dict)
+        train_pool.set_weight(weight_vec)
+        model.fit(train_pool)
 
     else:
         raise Exception('Model config not supported')
@@ -132,7 +377,9 @@ def main(args=None)->None:
     print('Training completed')
     print(f'Saving model to. {args.destination_model}')
 
-    model.save_model(args.destination_model, format='json')
+    # same rule as in `predict.py`, so that the saved model can always be loaded
+    model_format = 'cbm' if args.destination_model.lower().endswith('.cbm') else 'json'
+    model.save_model(args.destination_model, format=model_format)
 
     print('Done')
 
@@ -1,29 +1,37 @@
-import duckdb as ddb
-import numpy as np
+import os
+import sys
 
-con = ddb.connect()
+# the shared helpers live next to the pipeline scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+from duckdb_utils import connect
 
-# Load the Parquet file into DuckDB
-con.execute(f"CREATE TABLE txns AS SELECT * FROM 'eval_txns.parquet'")
-con.execute(f"CREATE TABLE labels AS SELECT * FROM 'labels.parquet'")
+con = connect()
 
-# Execute a query to select 5 rows from the 'transactions' table
-res_df = con.execute(
-    f"""
+# Query the Parquet files directly, the 10% sample of transactions is drawn before the join
+# and only the selected columns are read from the files
+# the sample is stored once, so that both queries below see the same transactions
+con.execute("""
+    CREATE TEMP TABLE txn_sample AS
     SELECT
         T.transactionTime,
         L.reportedTime,
         T.eventId,
         T.transactionAmount,
         T.availableCash
-    FROM txns AS T
-    LEFT JOIN labels AS L
+    FROM 'eval_txns.parquet' AS T TABLESAMPLE 10 PERCENT (bernoulli)
+    LEFT JOIN 'labels.parquet' AS L
         ON L.eventId=T.eventId
-    WHERE RANDOM()<0.1
-    """
+    """)
+
+# the rate is aggregated by DuckDB, and only the labelled transactions are pulled as a dataframe
+label_rate = con.execute(
+    "SELECT AVG((reportedTime IS NOT NULL)::DOUBLE) FROM txn_sample"
+).fetchone()[0]
+res_df = con.execute(
+    "SELECT transactionTime, reportedTime FROM txn_sample WHERE reportedTime IS NOT NULL"
 ).df()
 
 con.close()
 
-print(f'Labels for {np.mean(res_df.reportedTime==res_df.reportedTime)*100:.3f}%')
-print(res_df.query('reportedTime==reportedTime')[['transactionTime', 'reportedTime']])
+print(f'Labels for {label_rate*100:.3f}%')
+print(res_df)